@@ -1,163 +1,454 @@
+import functools
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
 import essentia
 import essentia.standard as estd
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
+import scipy.fft
+from cachetools import LRUCache
+from joblib import Memory
 
 essentia.log.warningActive = False
 
+# On-disk cache for analysis results, reused across runs with the same arguments
+memory = Memory(os.environ.get("MOSAIC_CACHE_DIR", ".mosaic_cache"), verbose=0)
+
+# Version of the analysis output, part of the key of every cached analysis; bump
+# it whenever the features or the way they are computed change
+ANALYSIS_VERSION = 1
+
+# Bounded cache for decoded audio files, evicting least recently used ones
+AUDIO_MEMORY_CACHE_BYTES = 2 * 1024**3
+loaded_audio_files = LRUCache(
+    maxsize=AUDIO_MEMORY_CACHE_BYTES, getsizeof=lambda audio: audio.nbytes
+)
+# LRUCache is not thread-safe and Streamlit runs each session in its own thread
+loaded_audio_files_lock = threading.Lock()
+
+# Folder with decoded audio files, memory-mapped on later runs to skip decoding
+AUDIO_CACHE_DIR = os.path.join(
+    os.environ.get("MOSAIC_CACHE_DIR", ".mosaic_cache"), "audio"
+)
+# Size limit of AUDIO_CACHE_DIR, the oldest files are removed beyond it
+AUDIO_DISK_CACHE_BYTES = 8 * 1024**3
+
+# Number of MFCC coefficients extracted per frame
+N_MFCC = 13
+
+# Upper bound (in bytes) for the block of frames processed at once by the batched STFT
+STFT_MEMORY_BUDGET = 256 * 1024**2
+
+
+@functools.lru_cache(maxsize=None)
+def hann_window(size):
+    """
+    Build a Hann window matching essentia's Windowing(type="hann").
+
+    Essentia normalizes the window to unit area and scales it by 2. Windows are
+    computed once per size and shared, so the returned array is read-only.
+
+    :param size: Window size (in samples).
+    :return: Window as a float32 numpy array.
+    """
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / (size - 1))
+    window = (2 * window / window.sum()).astype(np.float32)
+    window.setflags(write=False)
+    return window
+
+
+def batched_spectra_and_loudness(
+    audio, frame_size, n_frames, memory_budget=STFT_MEMORY_BUDGET
+):
+    """
+    Compute the magnitude spectra and loudness of consecutive non-overlapping frames.
+
+    Frames are windowed and transformed a block at a time so the intermediate
+    complex matrix stays within the given memory budget; the loudness of each
+    block is computed while it is in cache. The FFT runs in single precision and
+    uses the number of threads set with scipy.fft.set_workers.
+
+    :param audio: Audio signal as a numpy array.
+    :param frame_size: Size of the frame (in samples).
+    :param n_frames: Number of frames to compute, starting at sample 0.
+    :param memory_budget: Maximum size (in bytes) of a block of frames.
+    :return: Tuple (spectra, loudness) with a float32 array of shape
+        (n_frames, frame_size // 2 + 1) and the loudness per frame.
+    """
+    window = hann_window(frame_size)
+    frames = audio[: n_frames * frame_size].reshape(n_frames, frame_size)
+    spectra = np.empty((n_frames, frame_size // 2 + 1), dtype=np.float32)
+    loudness = np.empty(n_frames, dtype=np.float32)
+    # Complex64 output dominates the per-frame footprint of a block
+    block_size = max(1, memory_budget // ((frame_size // 2 + 1) * 8))
+    for start in range(0, n_frames, block_size):
+        frames_block = frames[start : start + block_size]
+        loudness[start : start + block_size] = frame_loudness(frames_block)
+        spectra[start : start + block_size] = np.abs(
+            scipy.fft.rfft(frames_block * window, axis=1)
+        )
+    return spectra, loudness
+
+
+def frame_loudness(frames):
+    """
+    Compute the loudness of frames, normalized by frame length.
+
+    Matches essentia's Loudness (Steven's power law: energy ** 0.67).
+
+    :param frames: A frame, or a (n_frames, frame_size) matrix of frames.
+    :return: Loudness per frame.
+    """
+    energy = np.square(frames, dtype=np.float64).sum(axis=-1)
+    return energy**0.67 / frames.shape[-1]
+
+
+def load_audio(audio_path):
+    """
+    Load an audio file as mono, decoding it at most once while it is unchanged.
+
+    Decoded audio is kept in a bounded in-memory cache and saved as .npy in
+    AUDIO_CACHE_DIR, so later runs (and evicted files) memory-map it instead of
+    decoding the file again. The audio is shared between callers, who must not
+    modify it.
+
+    :param audio_path: Path to the audio file.
+    :return: Audio as a numpy array.
+    """
+    mtime = os.stat(audio_path).st_mtime_ns
+    cache_key = (audio_path, mtime)
+    with loaded_audio_files_lock:
+        audio = loaded_audio_files.get(cache_key)
+    if audio is not None:
+        return audio
+    path_key = hashlib.sha1(os.path.abspath(audio_path).encode()).hexdigest()
+    npy_path = os.path.join(AUDIO_CACHE_DIR, f"{path_key}_{mtime}.npy")
+    if os.path.exists(npy_path):
+        # Copy-on-write keeps the array writable for essentia without copying it
+        audio = np.load(npy_path, mmap_mode="c")
+    else:
+        audio = estd.MonoLoader(filename=audio_path)()
+        os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, audio)
+        os.replace(tmp_path, npy_path)
+        _prune_audio_cache(path_key, npy_path)
+    with loaded_audio_files_lock:
+        loaded_audio_files[cache_key] = audio
+    return audio
+
+
+def _prune_audio_cache(path_key, npy_path):
+    """
+    Remove decoded copies of older versions of a file, then the least recently
+    written files until the cache fits in AUDIO_DISK_CACHE_BYTES.
+
+    :param path_key: Key of the audio file path, the prefix of its cached files.
+    :param npy_path: Newly written cache file, which is always kept.
+    """
+    entries = []
+    for entry in os.scandir(AUDIO_CACHE_DIR):
+        if not entry.name.endswith(".npy") or entry.path == npy_path:
+            continue
+        if entry.name.startswith(f"{path_key}_"):
+            _remove_cache_file(entry.path)
+        else:
+            try:
+                stat = entry.stat()
+            except OSError:  # Removed meanwhile by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = os.path.getsize(npy_path) + sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= AUDIO_DISK_CACHE_BYTES:
+            break
+        _remove_cache_file(path)
+        total_bytes -= size
+
+
+def _remove_cache_file(path):
+    """Remove a cache file, ignoring files removed or still in use elsewhere."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=8)
+def _beat_positions(audio_path, mtime):
+    """Track the beat positions (in samples); mtime is only part of the cache key."""
+    beat_tracker_algo = estd.BeatTrackerDegara()
+    beat_positions = beat_tracker_algo(load_audio(audio_path))
+    return tuple(int(round(position * 44100)) for position in beat_positions)
+
 
 def analyze_sound(audio_path, frame_size=None, audio_id=None, sync_with_beats=False):
     """
     Analyze an audio file by splitting it into frames and computing features.
 
+    Results are cached on disk (see MOSAIC_CACHE_DIR) and recomputed when the
+    file modification time changes.
+
     :param audio_path: Path to the audio file.
     :param frame_size: Size of the frame (in samples) to use; if None the entire file is one frame.
     :param audio_id: Identifier for the audio (used in output).
     :param sync_with_beats: If True, use beat positions to determine frames.
-    :return: List of dictionaries with analysis results per frame.
+    :return: DataFrame with analysis results per frame.
+    """
+    return _analyze_sound_cached(
+        audio_path,
+        frame_size,
+        audio_id,
+        sync_with_beats,
+        os.path.getmtime(audio_path),
+        ANALYSIS_VERSION,
+    )
+
+
+@memory.cache
+def _analyze_sound_cached(
+    audio_path, frame_size, audio_id, sync_with_beats, mtime, analysis_version
+):
+    """
+    Compute the analysis of analyze_sound.
+
+    mtime and analysis_version are only part of the cache key.
     """
-    analysis_output = []
-    loader = estd.MonoLoader(filename=audio_path)
-    audio = loader()
+    audio = load_audio(audio_path)
 
     if frame_size is None:
         frame_size = len(audio)
     if frame_size % 2 != 0:
         frame_size += 1
 
+    spectra = None
     if sync_with_beats:
-        beat_tracker_algo = estd.BeatTrackerDegara()
-        beat_positions = beat_tracker_algo(audio)
-        beat_positions = [int(round(position * 44100)) for position in beat_positions]
+        beat_positions = _beat_positions(audio_path, mtime)
         frame_start_end_samples = list(zip(beat_positions[:-1], beat_positions[1:]))
     else:
         frame_start_samples = list(range(0, len(audio), frame_size))
         frame_start_end_samples = list(
             zip(frame_start_samples[:-1], frame_start_samples[1:])
         )
+    n_frames = len(frame_start_end_samples)
+    starts = np.array([fstart for fstart, _ in frame_start_end_samples], dtype=np.int64)
+    ends = np.array([fend for _, fend in frame_start_end_samples], dtype=np.int64)
+
+    # Per-frame features are written into preallocated arrays, one per column
+    loudness_values = np.empty(n_frames, dtype=np.float32)
+    mfccs = np.empty((n_frames, N_MFCC), dtype=np.float32)
+    features = {
+        name: np.empty(n_frames, dtype=np.float32)
+        for name in (
+            "spectral_centroid",
+            "danceability",
+            "flux",
+            "hfc",
+            "spectral_complexity",
+            "pitch_salience",
+        )
+    }
+    intensities = np.empty(n_frames, dtype=np.int64)
+
+    if not sync_with_beats:
+        # Fixed-size frames: compute every spectrum and loudness in one vectorized pass
+        spectra, loudness_values = batched_spectra_and_loudness(
+            audio, frame_size, n_frames
+        )
+
+    # Instantiate the algorithms once and reuse them for every frame
+    w_algo = estd.Windowing(type="hann", size=frame_size)
+    spectrum_algo = estd.Spectrum(size=frame_size)
+    mfcc_algo = estd.MFCC(inputSize=frame_size // 2 + 1, numberCoefficients=N_MFCC)
+    spectral_centroid_algo = estd.SpectralCentroidTime()
+    danceability_algo = estd.Danceability()
+    flux_algo = estd.Flux()
+    hfc_algo = estd.HFC()
+    spectral_complexity_algo = estd.SpectralComplexity()
+    pitch_salience_algo = estd.PitchSalience()
 
     for count, (fstart, fend) in enumerate(frame_start_end_samples):
         frame = audio[fstart:fend]
-        frame_output = {
-            "freesound_id": audio_id,
-            "id": f"{audio_id}_f{count}",
-            "path": audio_path,
-            "start_sample": fstart,
-            "end_sample": fend,
-        }
-        # Compute loudness and normalize by frame length
-        loudness_algo = estd.Loudness()
-        loudness = loudness_algo(frame)
-        frame_output["loudness"] = loudness / len(frame)
+        if spectra is not None:
+            spec = spectra[count]
+        else:
+            # Compute loudness (normalized by frame length) and spectrum per frame
+            loudness_values[count] = frame_loudness(frame)
+            spec = spectrum_algo(w_algo(frame))
 
         # Extract MFCC features
-        w_algo = estd.Windowing(type="hann")
-        spectrum_algo = estd.Spectrum()
-        mfcc_algo = estd.MFCC()
-        spec = spectrum_algo(w_algo(frame))
-        _, mfcc_coeffs = mfcc_algo(spec)
-        for j, coeff in enumerate(mfcc_coeffs):
-            frame_output[f"mfcc_{j}"] = coeff
+        _, mfccs[count] = mfcc_algo(spec)
 
         # Extract spectral centroid
-        spectral_centroid_algo = estd.SpectralCentroidTime()
-        spectral_centroid = spectral_centroid_algo(frame)
-        frame_output["spectral_centroid"] = spectral_centroid
+        features["spectral_centroid"][count] = spectral_centroid_algo(frame)
 
         # Danceability
-        danceability_algo = estd.Danceability()
-        danceability, _ = danceability_algo(frame)
-        frame_output["danceability"] = danceability
+        features["danceability"][count], _ = danceability_algo(frame)
 
-        # Spectral Flux
-        flux_algo = estd.Flux()
-        flux = flux_algo(spec)
-        frame_output["flux"] = flux
+        # Spectral Flux (reset so each frame is measured independently)
+        flux_algo.reset()
+        features["flux"][count] = flux_algo(spec)
 
         # High Frequency Content
-        hfc_algo = estd.HFC()
-        hfc = hfc_algo(spec)
-        frame_output["hfc"] = hfc
+        features["hfc"][count] = hfc_algo(spec)
 
         # Spectral Complexity
-        spectral_complexity_algo = estd.SpectralComplexity()
-        spectral_complexity = spectral_complexity_algo(spec)
-        frame_output["spectral_complexity"] = spectral_complexity
+        features["spectral_complexity"][count] = spectral_complexity_algo(spec)
 
         # Pitch Salience
-        pitch_salience_algo = estd.PitchSalience()
-        pitch_salience = pitch_salience_algo(spec)
-        frame_output["pitch_salience"] = pitch_salience
+        features["pitch_salience"][count] = pitch_salience_algo(spec)
 
-        # Intensity
-        intensity_algo = estd.Intensity()
-        intensity = intensity_algo(frame)
-        frame_output["intensity"] = intensity
+        # Intensity (an Intensity instance fails on its second compute, so a new
+        # one is created for every frame)
+        intensities[count] = estd.Intensity()(frame)
 
-        analysis_output.append(frame_output)
+    # Assemble the DataFrame column by column from the feature arrays
+    analysis_output = pd.DataFrame(
+        {
+            "freesound_id": [audio_id] * n_frames,
+            "id": np.char.add(f"{audio_id}_f", np.arange(n_frames).astype(str)),
+            "path": [audio_path] * n_frames,
+            "start_sample": starts,
+            "end_sample": ends,
+            "loudness": loudness_values,
+            **{f"mfcc_{j}": mfccs[:, j] for j in range(N_MFCC)},
+            **features,
+            "intensity": intensities,
+        }
+    )
     return analysis_output
 
 
-def analyze_collection(df, frame_size, output_csv):
+def _analyze_one(sound):
+    """Analyze a single source sound record, skipping files that fail to load."""
+    try:
+        return analyze_sound(
+            sound["path"],
+            frame_size=sound["frame_size"],
+            audio_id=sound["freesound_id"],
+        )
+    except (RuntimeError, OSError) as e:
+        print(f'Skipping sound with id {sound["freesound_id"]}: {e}')
+        return None
+
+
+def analyze_collection(df, frame_size, output_path, max_workers=None):
     """
     Analyze each sound in the source collection.
 
+    Sounds are analyzed in parallel, one per worker process.
+
     :param df: DataFrame with source sounds metadata.
     :param frame_size: Frame size (in samples) for analysis.
-    :param output_csv: CSV file to store analysis results.
-    :return: DataFrame with analysis results.
+    :param output_path: Parquet file to store analysis results.
+    :param max_workers: Number of worker processes; defaults to the number of CPUs.
+    :return: DataFrame with analysis results. The ids of the sounds that could not
+        be analyzed are listed in its attrs["skipped_freesound_ids"].
     """
+    sounds = [
+        {"path": path, "freesound_id": freesound_id, "frame_size": frame_size}
+        for path, freesound_id in zip(df["path"], df["freesound_id"])
+    ]
     analyses = []
-    for i in range(len(df)):
-        sound = df.iloc[i]
-        print(f'Analyzing sound with id {sound["freesound_id"]} [{i + 1}/{len(df)}]')
-        try:
-            analysis_output = analyze_sound(
-                sound["path"], frame_size=frame_size, audio_id=sound["freesound_id"]
+    skipped_ids = []
+    # Spawn the workers, as forking a multi-threaded process (e.g. the Streamlit
+    # server) can deadlock
+    with ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        results = executor.map(_analyze_one, sounds, chunksize=4)
+        for i, (sound, analysis_output) in enumerate(zip(sounds, results)):
+            status = "Analyzed" if analysis_output is not None else "Skipped"
+            print(
+                f'{status} sound with id {sound["freesound_id"]} '
+                f"[{i + 1}/{len(sounds)}]"
             )
-            analyses.extend(analysis_output)
-        except RuntimeError:
-            continue
-    df_source = pd.DataFrame(analyses)
-    df_source.to_csv(output_csv, index=False)
+            if analysis_output is not None:
+                analyses.append(analysis_output)
+            else:
+                skipped_ids.append(sound["freesound_id"])
+    if skipped_ids:
+        print(f"Could not analyze {len(skipped_ids)} of {len(sounds)} sounds")
+    df_source = pd.concat(analyses, ignore_index=True) if analyses else pd.DataFrame()
+    df_source.to_parquet(output_path, index=False)
     print(
-        f"Saved source analysis DataFrame with {len(df_source)} entries to {output_csv}"
+        f"Saved source analysis DataFrame with {len(df_source)} entries to {output_path}"
     )
+    df_source.attrs["skipped_freesound_ids"] = skipped_ids
     return df_source
 
 
-def analyze_target(audio_path, frame_size, sync_with_beats, output_csv):
+def analyze_target(audio_path, frame_size, sync_with_beats, output_path):
     """
     Analyze the target audio file.
 
     :param audio_path: Path to the target audio.
     :param frame_size: Frame size (in samples) for analysis.
     :param sync_with_beats: Whether to sync frames with beats.
-    :param output_csv: CSV file to store target analysis results.
+    :param output_path: Parquet file to store target analysis results.
     :return: DataFrame with target analysis.
     """
     print(f"Analyzing target sound: {audio_path}")
-    target_analysis = analyze_sound(
-        audio_path,
-        frame_size=frame_size,
-        audio_id=audio_path,
-        sync_with_beats=sync_with_beats,
-    )
-    df_target = pd.DataFrame(target_analysis)
-    df_target.to_csv(output_csv, index=False)
+    # A single file is analyzed, so let the FFT use every core
+    with scipy.fft.set_workers(os.cpu_count()):
+        df_target = analyze_sound(
+            audio_path,
+            frame_size=frame_size,
+            audio_id=audio_path,
+            sync_with_beats=sync_with_beats,
+        )
+    df_target.to_parquet(output_path, index=False)
     print(
-        f"Saved target analysis DataFrame with {len(df_target)} entries to {output_csv}"
+        f"Saved target analysis DataFrame with {len(df_target)} entries to {output_path}"
     )
     return df_target
 
 
-def plot_waveform_with_frames(audio_path, df_target, duration_seconds=4):
-    """Plot the waveform of an audio file with vertical lines at each frame start."""
-    loader = estd.MonoLoader(filename=audio_path)
-    audio = loader()
-    plt.figure(figsize=(15, 5))
-    plt.plot(audio)
-    plt.vlines(df_target["start_sample"].values, -1, 1, color="red")
-    plt.axis([0, min(len(audio), 44100 * duration_seconds), -1, 1])
-    plt.title("Target audio file (first 4 seconds)")
-    plt.show()
+def waveform_envelope(audio, n_points=1500):
+    """
+    Compute the min/max envelope of a waveform for plotting.
+
+    Each of the ~n_points blocks keeps its minimum and maximum, so peaks stay
+    visible while drawing far fewer vertices than samples.
+
+    :param audio: Audio as a numpy array.
+    :param n_points: Approximate number of blocks in the envelope.
+    :return: Tuple (positions, mins, maxs) with the first sample of each block
+        and the minimum and maximum values within it.
+    """
+    if len(audio) == 0:
+        return np.arange(0), audio[:0], audio[:0]
+    block_size = max(1, len(audio) // n_points)
+    positions = np.arange(0, len(audio), block_size)
+    return (
+        positions,
+        np.minimum.reduceat(audio, positions),
+        np.maximum.reduceat(audio, positions),
+    )
+
+
+def plot_waveform_with_frames(audio, df_target, duration_seconds=4):
+    """
+    Plot the waveform of an audio file with vertical lines at each frame start.
+
+    :param audio: Audio as a numpy array, or path to the audio file.
+    :param df_target: DataFrame with the target analysis.
+    :param duration_seconds: Number of seconds to show from the start.
+    :return: Matplotlib Figure with the plot.
+    """
+    if isinstance(audio, str):
+        audio = load_audio(audio)
+    n_samples = min(len(audio), 44100 * duration_seconds)
+    fig, ax = plt.subplots(figsize=(15, 5))
+    ax.fill_between(*waveform_envelope(audio[:n_samples]))
+    ax.vlines(df_target["start_sample"].values, -1, 1, color="red")
+    ax.axis([0, n_samples, -1, 1])
+    ax.set_title(f"Target audio file (first {duration_seconds} seconds)")
+    return fig
@@ -1,5 +1,6 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import freesound
 import pandas as pd
@@ -10,7 +11,8 @@ if not FREESOUND_API_KEY:
     raise ValueError("FREESOUND_API_KEY environment variable is not set")
 
 FILES_DIR = "files"  # Folder for downloaded audio files
-DATAFRAME_FILENAME = "dataframe.csv"
+DOWNLOAD_WORKERS = 16  # Number of sound previews downloaded concurrently
+DATAFRAME_FILENAME = "dataframe.parquet"
 FREESOUND_STORE_METADATA_FIELDS = [
     "id",
     "name",
@@ -49,44 +51,70 @@ def retrieve_sound_preview(sound, directory):
     return freesound.FSRequest.retrieve(file_url, freesound_client, filename)
 
 
-def make_pandas_record(sound):
-    """Create a dictionary with selected metadata for the given sound."""
-    record = {key: sound.as_dict()[key] for key in FREESOUND_STORE_METADATA_FIELDS}
-    del record["previews"]  # Remove preview details
-    record["freesound_id"] = record.pop("id")
-    record["path"] = os.path.join(
-        FILES_DIR, os.path.basename(sound.previews.preview_hq_ogg)
-    )
-    return record
-
+def make_pandas_columns(sounds):
+    """
+    Create a column-oriented dictionary with selected metadata for the given sounds.
 
-def download_collection(queries, override_files=True):
+    :param sounds: List of Freesound sounds.
+    :return: Dictionary mapping each column name to its list of values.
+    """
+    # Metadata fields other than the preview details, plus the id and local path
+    fields = [
+        field
+        for field in FREESOUND_STORE_METADATA_FIELDS
+        if field not in ("id", "previews")
+    ]
+    columns = {key: [] for key in fields + ["freesound_id", "path"]}
+    for sound in sounds:
+        for field in fields:
+            columns[field].append(getattr(sound, field))
+        columns["freesound_id"].append(sound.id)
+        columns["path"].append(
+            os.path.join(FILES_DIR, os.path.basename(sound.previews.preview_hq_ogg))
+        )
+    return columns
+
+
+def download_collection(queries, override_files=True, on_downloaded=None):
     """
     Download the source audio collection.
 
     :param queries: List of dictionaries with keys 'query', 'filter', and 'num_results'
     :param override_files: If True, clears the FILES_DIR before downloading.
+    :param on_downloaded: Optional callable called with each sound, the number of
+        sounds downloaded so far and the total, as each download completes.
     :return: DataFrame containing metadata of the downloaded sounds.
     """
     if override_files and os.path.exists(FILES_DIR):
         shutil.rmtree(FILES_DIR)
     os.makedirs(FILES_DIR, exist_ok=True)
 
-    # Aggregate sounds from all queries
-    sounds = []
-    for query_info in queries:
-        q = query_info.get("query")
-        f = query_info.get("filter")
-        n = query_info.get("num_results", 10)
-        sounds += query_freesound(q, f, n)
-
-    # Download each sound preview
-    for count, sound in enumerate(sounds):
-        print(f"Downloading sound with id {sound.id} [{count + 1}/{len(sounds)}]")
-        retrieve_sound_preview(sound, FILES_DIR)
-
-    # Save metadata as a CSV file
-    df = pd.DataFrame([make_pandas_record(s) for s in sounds])
-    df.to_csv(DATAFRAME_FILENAME, index=False)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        # Run the queries concurrently, aggregating the sounds in query order
+        results = executor.map(
+            lambda query_info: query_freesound(
+                query_info.get("query"),
+                query_info.get("filter"),
+                query_info.get("num_results", 10),
+            ),
+            queries,
+        )
+        sounds = [sound for result in results for sound in result]
+
+        # Download the sound previews concurrently (network-bound)
+        futures = {
+            executor.submit(retrieve_sound_preview, sound, FILES_DIR): sound
+            for sound in sounds
+        }
+        for count, future in enumerate(as_completed(futures)):
+            future.result()
+            sound = futures[future]
+            print(f"Downloaded sound with id {sound.id} [{count + 1}/{len(sounds)}]")
+            if on_downloaded is not None:
+                on_downloaded(sound, count + 1, len(sounds))
+
+    # Save metadata as a Parquet file
+    df = pd.DataFrame(make_pandas_columns(sounds), copy=False)
+    df.to_parquet(DATAFRAME_FILENAME, index=False)
     print(f"Saved DataFrame with {len(df)} entries to {DATAFRAME_FILENAME}")
     return df
@@ -1,5 +1,6 @@
 import argparse
 
+import matplotlib.pyplot as plt
 import pandas as pd
 
 from analyzer import (analyze_collection, analyze_target,
@@ -40,25 +41,26 @@ def main():
         print("Downloading audio collection...")
         df = download_collection(queries, override_files=True)
     else:
-        df = pd.read_csv(DATAFRAME_FILENAME)
+        df = pd.read_parquet(DATAFRAME_FILENAME)
 
     # Step 2: Analyze source collection and target file
     if args.step in ["analyze", "all"]:
         print("Analyzing source collection...")
         df_source = analyze_collection(
-            df, frame_size=args.frame_size, output_csv="dataframe_source.csv"
+            df, frame_size=args.frame_size, output_path="dataframe_source.parquet"
         )
         print("Analyzing target audio file...")
         df_target = analyze_target(
             args.target_audio,
             frame_size=args.frame_size,
             sync_with_beats=False,
-            output_csv="dataframe_target.csv",
+            output_path="dataframe_target.parquet",
         )
         plot_waveform_with_frames(args.target_audio, df_target)
+        plt.show()
     else:
-        df_source = pd.read_csv("dataframe_source.csv")
-        df_target = pd.read_csv("dataframe_target.csv")
+        df_source = pd.read_parquet("dataframe_source.parquet")
+        df_target = pd.read_parquet("dataframe_target.parquet")
 
     # Step 3: Audio mosaicing reconstruction
     if args.step in ["mosaic", "all"]:
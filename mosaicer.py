@@ -7,8 +7,7 @@ import numpy as np
 from IPython.display import Audio, display
 from sklearn.neighbors import NearestNeighbors
 
-# Cache for loaded audio files
-loaded_audio_files = {}
+from analyzer import load_audio, waveform_envelope
 
 # Features to use for similarity
 # fmt: off
@@ -26,60 +25,49 @@ similarity_features = [
 # fmt: on
 
 
-def get_audio_file_segment(file_path, start_sample, n_samples):
+def find_similar_frames(df_query_frames, df_source_frames, n, features):
     """
-    Load an audio file (with caching) and return a segment.
+    Find the n most similar source frames for every query frame.
 
-    :param file_path: Path to the audio file.
-    :param start_sample: Starting sample index.
-    :param n_samples: Number of samples to return.
-    :return: Audio segment as a numpy array.
-    """
-    if file_path not in loaded_audio_files:
-        loader = estd.MonoLoader(filename=file_path)
-        audio = loader()
-        loaded_audio_files[file_path] = audio
-    else:
-        audio = loaded_audio_files[file_path]
-    return audio[start_sample : start_sample + n_samples]
+    All query frames are matched at once with a brute-force search, which for
+    collections of this size is a few BLAS matrix products and beats a tree index.
+    Features are standardized with the source statistics so that features on
+    very different scales (e.g. MFCCs and loudness) weigh equally.
 
-
-def find_similar_frames(query_frame, df_source_frames, n, features):
-    """
-    Find the n most similar frames in the source DataFrame.
-
-    :param query_frame: Numpy array of feature values for the query.
+    :param df_query_frames: DataFrame containing query (target) frames.
     :param df_source_frames: DataFrame containing source frames.
     :param n: Number of neighbors to find.
     :param features: List of feature column names to use.
-    :return: List of similar frame records.
+    :return: Array of shape (n_queries, n) with the positions of the similar
+        source frames, sorted from most to least similar.
     """
-    query_frame = query_frame.reshape(1, -1)
-    nbrs = NearestNeighbors(n_neighbors=n, algorithm="ball_tree").fit(
-        df_source_frames[features].values
+    # float32 halves the bytes touched by the distance computations
+    source_mat = df_source_frames[features].to_numpy(dtype=np.float32, copy=True)
+    query_mat = df_query_frames[features].to_numpy(dtype=np.float32, copy=True)
+    mean = source_mat.mean(axis=0, dtype=np.float64).astype(np.float32)
+    std = (source_mat.std(axis=0, dtype=np.float64) + 1e-9).astype(np.float32)
+    # Standardize in place to avoid temporary copies of the feature matrices
+    for mat in (source_mat, query_mat):
+        mat -= mean
+        mat /= std
+    nbrs = NearestNeighbors(n_neighbors=min(n, len(source_mat)), algorithm="brute").fit(
+        source_mat
     )
-    distances, indices = nbrs.kneighbors(query_frame)
-    return [df_source_frames.iloc[k] for k in indices[0]]
+    distances, indices = nbrs.kneighbors(query_mat)
+    return indices
 
 
 def choose_frame_from_source_collection(
-    target_frame,
-    df_source_frames,
-    similarity_features=similarity_features,
+    similar_frames,
     choice="random",  # random or best
 ):
     """
-    Choose a source frame that best matches the target frame.
+    Choose a source frame among the candidates similar to a target frame.
 
-    This function uses MFCC features for similarity and returns a random
-    frame among the top similar candidates.
+    :param similar_frames: Positions of the candidate source frames, most similar first.
+    :param choice: "random" picks any candidate, "best" picks the most similar one.
+    :return: Position of the chosen source frame.
     """
-    n_neighbours_to_find = 10
-    query_frame = target_frame[similarity_features].values
-    similar_frames = find_similar_frames(
-        query_frame, df_source_frames, n_neighbours_to_find, similarity_features
-    )
-    # return random.choice(similar_frames)
     if choice == "random":
         return random.choice(similar_frames)
     elif choice == "best":
@@ -103,30 +91,45 @@ def reconstruct_audio(
     :param output_filename: Output WAV filename.
     :return: Tuple (generated_audio, target_audio, selected_freesound_ids)
     """
-    target_sound_filename = df_target.iloc[0]["path"]
-    target_audio = estd.MonoLoader(filename=target_sound_filename)()
+    target_sound_filename = df_target["path"].iat[0]
+    target_audio = load_audio(target_sound_filename)
     total_length_target_audio = len(target_audio)
-    generated_audio = np.zeros(total_length_target_audio)
-    selected_freesound_ids = []
+    generated_audio = np.zeros(total_length_target_audio, dtype=np.float32)
 
     print("Reconstructing audio file...")
-    for i in range(len(df_target)):
-        target_frame = df_target.iloc[i]
-        source_frame = choose_frame_from_source_collection(
-            target_frame=target_frame,
-            df_source_frames=df_source,
-            similarity_features=similarity_features,
-            choice=choice,
-        )
-        selected_freesound_ids.append(source_frame["freesound_id"])
-        frame_length = target_frame["end_sample"] - target_frame["start_sample"]
-        source_audio_segment = get_audio_file_segment(
-            source_frame["path"], source_frame["start_sample"], frame_length
+    n_neighbours_to_find = 10
+    similar_frames = find_similar_frames(
+        df_target, df_source, n_neighbours_to_find, similarity_features
+    )
+    # Plain arrays avoid materializing a pandas Series per frame in the loop
+    target_starts = df_target["start_sample"].to_numpy()
+    target_ends = df_target["end_sample"].to_numpy()
+    source_paths = df_source["path"].to_numpy(dtype=object)
+    source_starts = df_source["start_sample"].to_numpy()
+    source_ids = df_source["freesound_id"].to_numpy()
+    chosen_frames = np.array(
+        [
+            choose_frame_from_source_collection(similar_frames[i], choice=choice)
+            for i in range(len(df_target))
+        ],
+        dtype=np.intp,
+    )
+    selected_freesound_ids = source_ids[chosen_frames].tolist()
+    # Decode each selected source file once before splicing the segments
+    source_audios = {
+        path: load_audio(path) for path in set(source_paths[chosen_frames])
+    }
+    # Gather every selected segment, then scatter them into the output buffer
+    frame_lengths = target_ends - target_starts
+    segment_starts = source_starts[chosen_frames]
+    source_segments = [
+        source_audios[path][start : start + length]
+        for path, start, length in zip(
+            source_paths[chosen_frames], segment_starts, frame_lengths
         )
-        generated_audio[
-            target_frame["start_sample"] : target_frame["start_sample"]
-            + len(source_audio_segment)
-        ] = source_audio_segment
+    ]
+    for segment, target_start in zip(source_segments, target_starts):
+        generated_audio[target_start : target_start + len(segment)] = segment
 
     estd.MonoWriter(filename=output_filename, format="wav", sampleRate=44100)(
         essentia.array(generated_audio)
@@ -138,13 +141,13 @@ def reconstruct_audio(
 def plot_audio_signals(target_audio, generated_audio):
     """Plot the waveforms of the target and reconstructed audio."""
     plt.figure(figsize=(15, 5))
-    plt.plot(target_audio)
+    plt.fill_between(*waveform_envelope(target_audio))
     plt.axis([0, len(target_audio), -1, 1])
     plt.title("Target audio")
     plt.show()
 
     plt.figure(figsize=(15, 5))
-    plt.plot(generated_audio)
+    plt.fill_between(*waveform_envelope(generated_audio))
     plt.axis([0, len(target_audio), -1, 1])
     plt.title("Reconstructed audio")
     plt.show()
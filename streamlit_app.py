@@ -1,15 +1,211 @@
+import functools
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import threading
+
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import soundfile as sf
 import streamlit as st
 from streamlit_option_menu import option_menu
 
-from analyzer import (analyze_collection, analyze_target,
-                      plot_waveform_with_frames)
-from downloader import download_collection
-from mosaicer import reconstruct_audio
-
 st.set_page_config(layout="wide")
 
+# Folder for analyses reused across app sessions
+CACHE_DIR = os.environ.get("MOSAIC_CACHE_DIR", ".mosaic_cache")
+
+
+@functools.lru_cache(maxsize=None)
+def lazy_import(module_name):
+    """
+    Import one of the app modules on first use.
+
+    The analyzer, downloader and mosaicer modules pull in essentia, scikit-learn
+    and the Freesound client, so each page only imports the ones it needs.
+
+    :param module_name: Name of the module to import.
+    :return: The imported module.
+    """
+    return importlib.import_module(module_name)
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_download_collection(queries, _on_downloaded=None):
+    """
+    Download the source collection once per set of queries for an hour.
+
+    Files are kept between downloads so cached metadata keeps pointing at them.
+
+    :param queries: Tuple of (query, filter, num_results) tuples.
+    :param _on_downloaded: Optional progress callback, not part of the cache key.
+    :return: DataFrame with source sounds metadata.
+    """
+    return lazy_import("downloader").download_collection(
+        [dict(zip(("query", "filter", "num_results"), q)) for q in queries],
+        override_files=False,
+        on_downloaded=_on_downloaded,
+    )
+
+
+def downcast_numeric(df):
+    """
+    Cast float64 columns to float32 and int64 columns that fit to int32.
+
+    Analyses are kept in the session state, so this halves their memory footprint.
+
+    :param df: DataFrame with analysis results.
+    :return: DataFrame with the downcast columns.
+    """
+    dtypes = {col: np.float32 for col in df.select_dtypes("float64").columns}
+    for col in df.select_dtypes("int64").columns:
+        if df[col].abs().max() < 2**31:
+            dtypes[col] = np.int32
+    return df.astype(dtypes) if dtypes else df
+
+
+def cached_analyze_collection(meta_df, frame_size):
+    """
+    Analyze the source collection, reusing a previous analysis of the same sounds.
+
+    Analyses are stored as Parquet in CACHE_DIR, keyed by the downloaded sound ids,
+    the frame size and the analysis version. Analyses where some sounds failed are
+    not stored.
+
+    :param meta_df: DataFrame with source sounds metadata.
+    :param frame_size: Frame size (in samples) for analysis.
+    :return: DataFrame with analysis results.
+    """
+    analyzer = lazy_import("analyzer")
+    key = {
+        "freesound_ids": sorted(int(i) for i in meta_df["freesound_id"]),
+        "frame_size": int(frame_size),
+        "analysis_version": analyzer.ANALYSIS_VERSION,
+    }
+    digest = hashlib.blake2b(
+        json.dumps(key, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"source_{digest}.parquet")
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+    source_df = analyzer.analyze_collection(
+        meta_df, frame_size=frame_size, output_path="dataframe_source.parquet"
+    )
+    if source_df.empty or source_df.attrs["skipped_freesound_ids"]:
+        # Analyze the collection again next time instead of reusing a failed run
+        return source_df
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    shutil.copyfile("dataframe_source.parquet", cache_path)
+    return source_df
+
+
+@st.cache_data(show_spinner=False)
+def cached_analyze_target(target_path, file_digest, frame_size, sync_with_beats):
+    """
+    Analyze the target audio once per uploaded file and analysis settings.
+
+    :param target_path: Path where the uploaded target audio is saved.
+    :param file_digest: Digest of the uploaded file, only used as the cache key.
+    :param frame_size: Frame size (in samples) for analysis.
+    :param sync_with_beats: Whether to sync frames with beats.
+    :return: DataFrame with target analysis, downcast with downcast_numeric.
+    """
+    return downcast_numeric(
+        lazy_import("analyzer").analyze_target(
+            target_path,
+            frame_size=frame_size,
+            sync_with_beats=sync_with_beats,
+            output_path="dataframe_target.parquet",
+        )
+    )
+
+
+def render_waveform_png(target_path, target_df, duration_seconds):
+    """
+    Plot the target waveform with its frames and rasterize it to PNG.
+
+    :param target_path: Path where the uploaded target audio is saved.
+    :param target_df: DataFrame with the target analysis.
+    :param duration_seconds: Number of seconds to plot.
+    :return: PNG image as bytes.
+    """
+    analyzer = lazy_import("analyzer")
+    fig = analyzer.plot_waveform_with_frames(
+        analyzer.load_audio(target_path), target_df, duration_seconds=duration_seconds
+    )
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=90)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+@st.fragment
+def query_inputs():
+    """
+    Render the query inputs and store the resulting queries in the session.
+
+    As a fragment, editing a query only reruns these inputs.
+    """
+    num_queries = st.number_input(
+        "Number of queries", min_value=1, max_value=10, value=3
+    )
+    queries = []
+    default_queries = ["organ", "violin", "ocean"]
+    for i in range(int(num_queries)):
+        st.subheader(f"Query {i+1}")
+        query_text = st.text_input(
+            f"Query text {i+1}",
+            value=default_queries[i] if i < len(default_queries) else "",
+        )
+        query_filter = st.text_input(f"Filter (optional) {i+1}", value="")
+        num_results = st.number_input(
+            f"Number of results {i+1}", min_value=1, max_value=100, value=20
+        )
+        queries.append(
+            {
+                "query": query_text,
+                "filter": query_filter if query_filter != "" else None,
+                "num_results": num_results,
+            }
+        )
+    st.session_state.queries = queries
+
+
+@st.fragment
+def target_waveform(target_path, target_df, frame_size, sync_with_beats):
+    """
+    Render the target waveform plot with its own duration input.
+
+    As a fragment, changing the duration only reruns this plot.
+
+    :param target_path: Path where the uploaded target audio is saved.
+    :param target_df: DataFrame with the target analysis.
+    :param frame_size: Frame size (in samples) used for the analysis.
+    :param sync_with_beats: Whether the analysis frames are synced with beats.
+    """
+    st.write("Target Analysis Waveform:")
+    seconds_to_plot = st.number_input(
+        "Seconds to plot", min_value=1, max_value=600, value=4
+    )
+    # Only redraw the plot when the file, analysis or duration change
+    plot_signature = (
+        os.path.getmtime(target_path),
+        len(target_df),
+        int(frame_size),
+        sync_with_beats,
+        int(seconds_to_plot),
+    )
+    if st.session_state.target_plot_signature != plot_signature:
+        st.session_state.target_plot_png = render_waveform_png(
+            target_path, target_df, int(seconds_to_plot)
+        )
+        st.session_state.target_plot_signature = plot_signature
+    st.image(st.session_state.target_plot_png, use_container_width=True)
+
 
 st.logo("assets/upf_mtg.png", size="large")
 
@@ -24,14 +220,17 @@ Developed with ♥️, ☕️ and 🤖 by [Fernando Garcia de la Cruz](https://f
 )
 
 # Initialize session state variables if not present
-if "source_df" not in st.session_state:
-    st.session_state.source_df = None
-if "target_df" not in st.session_state:
-    st.session_state.target_df = None
-if "target_audio_path" not in st.session_state:
-    st.session_state.target_audio_path = None
-if "frame_size" not in st.session_state:
-    st.session_state.frame_size = 8192
+SESSION_DEFAULTS = {
+    "queries": [],
+    "source_df": None,
+    "target_df": None,
+    "target_audio_path": None,
+    "frame_size": 8192,
+    "target_plot_signature": None,
+    "target_plot_png": None,
+}
+for key, value in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, value)
 
 # Sidebar for navigation (only two pages now)
 with st.sidebar:
@@ -58,47 +257,57 @@ if page == "Downloader":
         "Frame Size (samples)", min_value=1024, max_value=44100, value=8192, step=1024
     )
 
-    # Dynamic query input
-    num_queries = st.number_input(
-        "Number of queries", min_value=1, max_value=10, value=3
-    )
-    queries = []
-    default_queries = ["organ", "violin", "ocean"]
-    for i in range(int(num_queries)):
-        st.subheader(f"Query {i+1}")
-        query_text = st.text_input(
-            f"Query text {i+1}",
-            value=default_queries[i] if i < len(default_queries) else "",
-        )
-        query_filter = st.text_input(f"Filter (optional) {i+1}", value="")
-        num_results = st.number_input(
-            f"Number of results {i+1}", min_value=1, max_value=100, value=20
-        )
-        queries.append(
-            {
-                "query": query_text,
-                "filter": query_filter if query_filter != "" else None,
-                "num_results": num_results,
-            }
-        )
+    query_inputs()
 
     if st.button("Download & Analyze Source Collection"):
-        st.info("Downloading sounds...")
         # Download sounds and get metadata DataFrame
-        meta_df = download_collection(queries, override_files=True)
-        st.success("Download complete!")
+        query_key = tuple(
+            (q["query"], q["filter"], int(q["num_results"]))
+            for q in st.session_state.queries
+        )
+        with st.status("Downloading sounds...") as status:
+            meta_df = cached_download_collection(
+                query_key,
+                _on_downloaded=lambda sound, count, total: status.update(
+                    label=f"Downloaded {count}/{total} sounds ({sound.name})"
+                ),
+            )
+            status.update(label="Download complete!", state="complete")
         st.dataframe(meta_df)
 
         st.info("Analyzing source collection...")
-        source_df = analyze_collection(
-            meta_df,
-            frame_size=st.session_state.frame_size,
-            output_csv="dataframe_source.csv",
-        )
-        st.session_state.source_df = source_df
-        st.success("Source collection analyzed!")
-        st.dataframe(source_df)
-        st.info("You can now go to the 'Analyzer' tab to analyze a target audio file.")
+        source_df = cached_analyze_collection(meta_df, st.session_state.frame_size)
+        if source_df.empty:
+            st.session_state.source_df = None
+            st.error(
+                "None of the downloaded sounds could be analyzed. "
+                "Try different queries or a smaller frame size."
+            )
+        else:
+            # Index the frames by their (integer) sound id so the sounds used in a
+            # reconstruction can be looked up without scanning the whole column
+            source_df["freesound_id"] = pd.to_numeric(
+                source_df["freesound_id"], downcast="integer"
+            )
+            source_df = (
+                downcast_numeric(source_df)
+                .set_index("freesound_id", drop=False)
+                .rename_axis(None)
+                .sort_index(kind="stable")
+            )
+            st.session_state.source_df = source_df
+            st.success("Source collection analyzed!")
+            # Only send a preview to the browser, the full analysis is downloadable
+            st.dataframe(source_df.head(200))
+            st.download_button(
+                "Download full CSV",
+                source_df.to_csv(index=False).encode(),
+                "source.csv",
+                mime="text/csv",
+            )
+            st.info(
+                "You can now go to the 'Analyzer' tab to analyze a target audio file."
+            )
 
 ##############################
 # Analyzer & Mosaicer Section
@@ -121,33 +330,32 @@ elif page == "Analyzer":
     sync_with_beats = st.checkbox("Sync with beats (this will ignore the frame size)")
 
     if uploaded_file is not None:
-        # Save the uploaded file to the current directory as "target.wav"
-        target_path = "target.wav"
-        with open(target_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        # Save the uploaded file to the current directory, named after its
+        # content so sessions never overwrite each other's target and an
+        # unchanged upload is not written again
+        file_digest = hashlib.blake2b(
+            uploaded_file.getbuffer(), digest_size=16
+        ).hexdigest()
+        target_path = f"target_{file_digest}.wav"
+        if not os.path.exists(target_path):
+            # Stream the upload to disk in 1 MiB chunks
+            tmp_path = f"{target_path}.{threading.get_ident()}.tmp"
+            uploaded_file.seek(0)
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
+            os.replace(tmp_path, target_path)
         st.session_state.target_audio_path = target_path
         st.audio(target_path, format="audio/wav")
 
         st.info("Analyzing target audio...")
-        target_df = analyze_target(
-            target_path,
-            frame_size=frame_size,
-            sync_with_beats=sync_with_beats,
-            output_csv="dataframe_target.csv",
+        target_df = cached_analyze_target(
+            target_path, file_digest, int(frame_size), sync_with_beats
         )
         st.session_state.target_df = target_df
         st.success("Target analysis complete!")
         st.dataframe(target_df)
 
-        st.write("Target Analysis Waveform:")
-        seconds_to_plot = st.number_input(
-            "Seconds to plot", min_value=1, max_value=600, value=4
-        )
-        plot_waveform_with_frames(
-            target_path, target_df, duration_seconds=seconds_to_plot
-        )
-        st.pyplot(plt.gcf())
-        plt.clf()
+        target_waveform(target_path, target_df, frame_size, sync_with_beats)
 
         st.subheader("Mosaicing Options")
         st.write("Select the features to use for similarity:")
@@ -191,6 +399,7 @@ elif page == "Analyzer":
                 st.error("Please run the Downloader & Source Analysis step first!")
             else:
                 output_filename = "reconstructed_output.wav"
+                reconstruct_audio = lazy_import("mosaicer").reconstruct_audio
                 generated_audio, target_audio, selected_ids = reconstruct_audio(
                     st.session_state.source_df,
                     st.session_state.target_df,
@@ -198,16 +407,24 @@ elif page == "Analyzer":
                     similarity_features=selected_features,
                     choice=mosaicing_sample_selection,
                 )
+                # Share one contiguous float32 buffer per signal between the
+                # plot and the mix, so neither converts the arrays again
+                generated_audio = np.ascontiguousarray(
+                    generated_audio, dtype=np.float32
+                )
+                target_audio = np.ascontiguousarray(target_audio, dtype=np.float32)
                 st.success("Audio mosaicing complete!")
                 st.info(f"Selected features: {selected_features}")
                 st.info(f"Selected choice: {mosaicing_sample_selection}")
 
                 st.subheader("Reconstructed Audio Waveform")
                 fig2, ax2 = plt.subplots(figsize=(15, 4))
-                ax2.plot(generated_audio)
+                ax2.fill_between(
+                    *lazy_import("analyzer").waveform_envelope(generated_audio)
+                )
                 ax2.set_title("Reconstructed Audio")
                 st.pyplot(fig2)
-                plt.clf()
+                plt.close(fig2)
 
                 st.subheader("Listen to the Results")
                 st.write("**Target Audio:**")
@@ -215,15 +432,16 @@ elif page == "Analyzer":
                 st.write("**Reconstructed Audio:**")
                 st.audio(output_filename)
                 st.write("**Mixed Audio (50/50):**")
-                mix = (target_audio * 0.5 + generated_audio * 0.5).astype(np.float32)
+                # Mix into a single float32 buffer without intermediate arrays
+                mix = np.add(target_audio, generated_audio)
+                mix *= 0.5
                 mix_file = "mix.wav"
-                from essentia.standard import MonoWriter
-
-                MonoWriter(filename=mix_file, format="wav", sampleRate=44100)(mix)
+                sf.write(mix_file, mix, 44100, subtype="PCM_16")
                 st.audio(mix_file)
 
                 st.write("**Freesound IDs used in the reconstruction:**")
-                ids_used = st.session_state.source_df[
-                    st.session_state.source_df["freesound_id"].isin(selected_ids)
+                source_df = st.session_state.source_df
+                ids_used = source_df.loc[
+                    source_df.index.intersection(pd.Index(selected_ids))
                 ]
                 st.dataframe(ids_used)
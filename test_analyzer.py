@@ -0,0 +1,60 @@
+import essentia.standard as estd
+import numpy as np
+import pandas as pd
+import pytest
+
+from analyzer import analyze_sound
+
+
+@pytest.fixture
+def multi_frame_audio_path(tmp_path):
+    """Write a few seconds of a changing tone plus noise to a WAV file."""
+    rng = np.random.default_rng(0)
+    t = np.arange(3 * 44100) / 44100
+    audio = 0.5 * np.sin(2 * np.pi * (220 + 200 * t) * t) * (0.2 + t / 3)
+    audio += 0.05 * rng.standard_normal(len(t))
+    audio_path = str(tmp_path / "multi_frame.wav")
+    estd.MonoWriter(filename=audio_path, format="wav", sampleRate=44100)(
+        audio.astype(np.float32)
+    )
+    return audio_path
+
+
+def analyze_frame_with_new_algorithms(frame):
+    """Analyze one frame with freshly instantiated algorithms."""
+    spec = estd.Spectrum()(estd.Windowing(type="hann")(frame))
+    _, mfcc_coeffs = estd.MFCC()(spec)
+    return {
+        "loudness": estd.Loudness()(frame) / len(frame),
+        **{f"mfcc_{j}": coeff for j, coeff in enumerate(mfcc_coeffs)},
+        "spectral_centroid": estd.SpectralCentroidTime()(frame),
+        "danceability": estd.Danceability()(frame)[0],
+        "flux": estd.Flux()(spec),
+        "hfc": estd.HFC()(spec),
+        "spectral_complexity": estd.SpectralComplexity()(spec),
+        "pitch_salience": estd.PitchSalience()(spec),
+        "intensity": estd.Intensity()(frame),
+    }
+
+
+@pytest.mark.parametrize("frame_size", [8192, 4096, 2049])
+def test_analyze_sound_matches_per_frame_algorithms(multi_frame_audio_path, frame_size):
+    df = pd.DataFrame(
+        analyze_sound(multi_frame_audio_path, frame_size=frame_size, audio_id=1)
+    )
+    assert len(df) > 1
+
+    audio = estd.MonoLoader(filename=multi_frame_audio_path)()
+    expected = [
+        analyze_frame_with_new_algorithms(audio[start:end])
+        for start, end in zip(df["start_sample"], df["end_sample"])
+    ]
+    for column in expected[0]:
+        values = np.array([frame[column] for frame in expected], dtype=np.float64)
+        np.testing.assert_allclose(
+            df[column].to_numpy(dtype=np.float64),
+            values,
+            rtol=1e-3,
+            atol=1e-3 * np.abs(values).max(),
+            err_msg=column,
+        )